@@ -1,17 +1,45 @@
 import os
 import asyncio
+import atexit
 import logging
 import logging.handlers
 import json
+import queue
+import re
+import signal
+import struct
 import subprocess
+import time
 import aiohttp
-import tempfile
+from collections import defaultdict, deque
 from typing import Optional
 from datetime import datetime, timezone
 
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
+
+# Prefer orjson for the stream-json hot path; fall back to the stdlib parser
+try:
+    import orjson
+    json_loads = orjson.loads
+    JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    json_loads = json.loads
+    # json.loads(bytes) raises UnicodeDecodeError on invalid UTF-8; ValueError covers both
+    JSONDecodeError = ValueError
+
+# uvloop is optional and unavailable on Windows, where the default asyncio loop is used
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# fcntl is POSIX-only; it's used to enlarge the Claude CLI's stdout pipe on Linux
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 #from claude_code_sdk import query, ClaudeCodeOptions
 
 load_dotenv()
@@ -19,62 +47,189 @@ load_dotenv()
 # Set Claude CLI path in environment
 os.environ["PATH"] = f"/usr/local/bin/claude:{os.environ.get('PATH', '')}"
 
-# Setup logging with file output and rotating logs
-log_formatter = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+logger = logging.getLogger(__name__)
 
-# Create logs directory if it doesn't exist
-os.makedirs('logs', exist_ok=True)
+# Create separate logger for Claude streams
+# Set CLAUDE_STREAM_LOG=DEBUG to also record raw stream lines to logs/claude_stream.bin
+claude_stream_logger = logging.getLogger('claude_stream')
+claude_stream_logger.setLevel(os.getenv('CLAUDE_STREAM_LOG', 'INFO').upper())
+claude_stream_logger.propagate = False  # Don't send to root logger
 
-# Setup rotating file handler for general logs
-file_handler = logging.handlers.RotatingFileHandler(
-    'logs/discord_bot.log',
-    maxBytes=10*1024*1024,  # 10MB
-    backupCount=5
-)
-file_handler.setFormatter(log_formatter)
-file_handler.setLevel(logging.INFO)
+# Background writer for the Claude stream log, started by configure_logging()
+claude_stream_listener = None
 
-# Setup rotating file handler for Claude stream logs (unparsed)
-claude_stream_handler = logging.handlers.RotatingFileHandler(
-    'logs/claude_stream.log',
-    maxBytes=50*1024*1024,  # 50MB for large streams
-    backupCount=10
-)
-claude_stream_formatter = logging.Formatter('%(asctime)s - %(message)s')
-claude_stream_handler.setFormatter(claude_stream_formatter)
-claude_stream_handler.setLevel(logging.INFO)
+class RawStreamRecorder:
+    """Append raw stream-json lines to a rotating binary file
+    
+    Each record is a little-endian (float64 timestamp, uint32 length) header followed
+    by the line bytes, so lines are written without going through logging or repr().
+    """
+    HEADER = struct.Struct('<dI')
+    
+    def __init__(self, path: str, max_bytes: int, backup_count: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = open(path, 'ab', buffering=1 << 20)
+        self._size = self._file.tell()
+        
+    def write(self, line: bytes):
+        self._file.write(self.HEADER.pack(time.time(), len(line)))
+        self._file.write(line)
+        self._size += self.HEADER.size + len(line)
+        if self._size >= self.max_bytes:
+            self._rotate()
+            
+    def _rotate(self):
+        """Shift backups the same way RotatingFileHandler does and start a new file"""
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, 'ab', buffering=1 << 20)
+        self._size = 0
+        
+    def close(self):
+        self._file.close()
 
-# Setup console handler
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(log_formatter)
-console_handler.setLevel(logging.INFO)
+def iter_raw_stream(path: str):
+    """Yield (timestamp, line) records from a file written by RawStreamRecorder"""
+    header = RawStreamRecorder.HEADER
+    with open(path, 'rb') as f:
+        while chunk := f.read(header.size):
+            if len(chunk) < header.size:
+                break  # Truncated by a crash mid-write
+            timestamp, length = header.unpack(chunk)
+            yield timestamp, f.read(length)
 
-# Configure root logger
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[file_handler, console_handler]
-)
+# Raw stream recorder, created by configure_logging() when CLAUDE_STREAM_LOG=DEBUG
+raw_stream_recorder = None
 
-logger = logging.getLogger(__name__)
+def configure_logging():
+    """Set up console and rotating file logging; called once when the bot starts"""
+    global claude_stream_listener, raw_stream_recorder
+    
+    # Setup logging with file output and rotating logs
+    log_formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    
+    # Create logs directory if it doesn't exist
+    os.makedirs('logs', exist_ok=True)
+    
+    # Setup rotating file handler for general logs
+    file_handler = logging.handlers.RotatingFileHandler(
+        'logs/discord_bot.log',
+        maxBytes=10*1024*1024,  # 10MB
+        backupCount=5
+    )
+    file_handler.setFormatter(log_formatter)
+    file_handler.setLevel(logging.INFO)
+    
+    # Setup rotating file handler for Claude stream logs (unparsed)
+    claude_stream_handler = logging.handlers.RotatingFileHandler(
+        'logs/claude_stream.log',
+        maxBytes=50*1024*1024,  # 50MB for large streams
+        backupCount=10
+    )
+    claude_stream_formatter = logging.Formatter('%(asctime)s - %(message)s')
+    claude_stream_handler.setFormatter(claude_stream_formatter)
+    claude_stream_handler.setLevel(logging.DEBUG)
+    
+    # Write Claude stream logs from a background thread so file I/O never blocks the event loop
+    claude_stream_queue = queue.SimpleQueue()
+    claude_stream_listener = logging.handlers.QueueListener(
+        claude_stream_queue, claude_stream_handler, respect_handler_level=True
+    )
+    claude_stream_listener.start()
+    atexit.register(stop_logging)
+    claude_stream_logger.addHandler(logging.handlers.QueueHandler(claude_stream_queue))
+    
+    # Record raw stream lines in binary form, only when asked for
+    if claude_stream_logger.isEnabledFor(logging.DEBUG):
+        raw_stream_recorder = RawStreamRecorder(
+            'logs/claude_stream.bin',
+            max_bytes=50*1024*1024,  # Same limits as the text stream log
+            backup_count=10
+        )
+    
+    # Setup console handler
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_formatter)
+    console_handler.setLevel(logging.INFO)
+    
+    # Configure root logger
+    logging.basicConfig(
+        level=logging.INFO,
+        handlers=[file_handler, console_handler]
+    )
 
-# Create separate logger for Claude streams
-claude_stream_logger = logging.getLogger('claude_stream')
-claude_stream_logger.setLevel(logging.INFO)
-claude_stream_logger.addHandler(claude_stream_handler)
-claude_stream_logger.propagate = False  # Don't send to root logger
+def stop_logging():
+    """Flush and stop the background stream log writers; safe to call more than once"""
+    global claude_stream_listener, raw_stream_recorder
+    if claude_stream_listener is not None:
+        claude_stream_listener.stop()
+        claude_stream_listener = None
+    if raw_stream_recorder is not None:
+        raw_stream_recorder.close()
+        raw_stream_recorder = None
 
 CLAUDE_CLI_PATH = "/usr/local/bin/claude"
 
+# Tools enabled for every Discord command, plus the joined --allowedTools value and
+# the fixed command prefix, built once instead of on every invocation
+CLAUDE_TOOLS = ["Read", "Write", "Edit", "MultiEdit", "LS", "NotebookRead", "NotebookEdit",
+                "Glob", "Grep", "Task", "Bash", "WebFetch", "WebSearch", "TodoRead", "TodoWrite", "exit_plan_mode"]
+_CLAUDE_TOOLS_ARG = ",".join(CLAUDE_TOOLS)
+CLAUDE_SYSTEM_PROMPT = "You are a helpful Discord bot assistant. Keep responses concise and Discord-friendly."
+_BASE_CMD = (CLAUDE_CLI_PATH, "--output-format", "stream-json", "--verbose")
+
+# stream-json events that produce no Discord output, matched on the raw line
+_IGNORED_LINE_PREFIXES = (b'{"type":"system","subtype":"init"',)
+# Most stream lines are assistant messages; these go straight to their handler
+_ASSISTANT_LINE_PREFIX = b'{"type":"assistant"'
+
+# Streamed text is batched into one Discord send per STREAM_BATCH_CHARS characters,
+# or STREAM_FLUSH_DELAY seconds after the first unsent character, whichever comes first
+STREAM_BATCH_CHARS = 1800  # Stays under Discord's 2000 character limit, so usually one message per flush
+STREAM_FLUSH_DELAY = 2.0
+STREAM_FLUSH_INTERVAL = 0.25
+
 class ClaudeBot(commands.Bot):
     def __init__(self):
         intents = discord.Intents.default()
         intents.message_content = True
         super().__init__(command_prefix='!', intents=intents)
+        # Shared session for attachment downloads, created once the event loop is running
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        
+    async def setup_hook(self):
+        self.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+        )
+        
+    async def close(self):
+        # The CLI runs in its own session, so Ctrl+C on the bot doesn't reach it or its children
+        if current_claude_process is not None and current_claude_process.returncode is None:
+            _signal_claude_process(current_claude_process, kill=True)
+        if self.http_session is not None:
+            await self.http_session.close()
+        await super().close()
+        stop_logging()
+        
+    async def login(self, token: str):
+        # discord.py creates its HTTP session in login(); give it a connector that keeps
+        # connections alive between message bursts and caches Discord's DNS for 5 minutes
+        self.http.connector = aiohttp.TCPConnector(limit=0, limit_per_host=20, ttl_dns_cache=300)
+        await super().login(token)
         
     async def on_ready(self):
         logger.info(f'{self.user} has connected to Discord!')
+        connector = self.http.connector
+        logger.info(f"Discord HTTP connector: limit_per_host={connector.limit_per_host}, "
+                    f"dns_cache={connector.use_dns_cache}")
         
     async def on_message(self, message):
         if message.author == self.user:
@@ -88,6 +243,9 @@ bot = ClaudeBot()
 current_claude_process = None
 current_claude_channel = None
 
+# Per-channel locks so multi-chunk messages are never interleaved with other sends
+_channel_send_locks = defaultdict(asyncio.Lock)
+
 def format_usage_limit_message(message: str) -> str:
     """Convert usage limit message with unix timestamp to human readable format"""
     if "Claude AI usage limit reached|" in message:
@@ -108,31 +266,31 @@ def format_usage_limit_message(message: str) -> str:
             return "🚫 **Claude AI Usage Limit Reached**\n⏰ Please try again later"
     return message
 
+# Matches the JSON array embedded in a TodoRead/TodoWrite result
+_TODO_JSON_RE = re.compile(r'\[.*\]', re.DOTALL)
+
 def format_todo_content(content: str) -> str:
     """Format todo list content for Discord display"""
     try:
-        import json
-        import re
-        
         # Handle simple messages first
         if "Todos have been modified successfully" in content:
             return "📋 **Todo List Updated Successfully**"
         
         if "Remember to continue to use" in content and "todo list" in content.lower():
             # Extract JSON from the TodoRead response
-            json_match = re.search(r'\[.*\]', content, re.DOTALL)
+            json_match = _TODO_JSON_RE.search(content)
             if json_match:
                 todos_json = json_match.group()
-                todos = json.loads(todos_json)
+                todos = json_loads(todos_json)
                 return format_todos_list(todos)
             else:
                 return "📋 **Todo List:** Error parsing content"
         
         # Try to extract JSON array from the content
-        json_match = re.search(r'\[.*\]', content, re.DOTALL)
+        json_match = _TODO_JSON_RE.search(content)
         if json_match:
             todos_json = json_match.group()
-            todos = json.loads(todos_json)
+            todos = json_loads(todos_json)
             return format_todos_list(todos)
         else:
             # Fallback for non-JSON todo content
@@ -144,189 +302,518 @@ def format_todo_content(content: str) -> str:
         # Fallback to original content if parsing fails
         return f"📋 **Todo Error:** `{content}`"
 
+_TODO_PRIORITY_EMOJI = {'high': "🔴", 'medium': "🟡"}  # Anything else is shown as low
+
 def format_todos_list(todos: list) -> str:
     """Format a list of todos for Discord display"""
     if not todos:
         return "📋 **Todo List:** Empty"
     
-    formatted = "📋 **Todo List:**\n"
+    parts = ["📋 **Todo List:**\n"]
     
-    # Group by status
-    in_progress = [t for t in todos if t.get('status') == 'in_progress']
-    pending = [t for t in todos if t.get('status') == 'pending']
-    completed = [t for t in todos if t.get('status') == 'completed']
+    # Group by status in a single pass
+    in_progress, pending, completed = [], [], []
+    by_status = {'in_progress': in_progress, 'pending': pending, 'completed': completed}
+    for todo in todos:
+        bucket = by_status.get(todo.get('status'))
+        if bucket is not None:
+            bucket.append(todo)
     
     if in_progress:
-        formatted += "\n🔄 **In Progress:**\n"
+        parts.append("\n🔄 **In Progress:**\n")
         for todo in in_progress:
-            priority_emoji = "🔴" if todo.get('priority') == 'high' else "🟡" if todo.get('priority') == 'medium' else "🟢"
-            formatted += f"  {priority_emoji} {todo.get('content', 'Unknown task')}\n"
+            priority_emoji = _TODO_PRIORITY_EMOJI.get(todo.get('priority'), "🟢")
+            parts.append(f"  {priority_emoji} {todo.get('content', 'Unknown task')}\n")
     
     if pending:
-        formatted += "\n⏳ **Pending:**\n"
+        parts.append("\n⏳ **Pending:**\n")
         for todo in pending:
-            priority_emoji = "🔴" if todo.get('priority') == 'high' else "🟡" if todo.get('priority') == 'medium' else "🟢"
-            formatted += f"  {priority_emoji} {todo.get('content', 'Unknown task')}\n"
+            priority_emoji = _TODO_PRIORITY_EMOJI.get(todo.get('priority'), "🟢")
+            parts.append(f"  {priority_emoji} {todo.get('content', 'Unknown task')}\n")
     
     if completed:
-        formatted += "\n✅ **Completed:**\n"
+        parts.append("\n✅ **Completed:**\n")
         for todo in completed:
-            formatted += f"  ✓ {todo.get('content', 'Unknown task')}\n"
+            parts.append(f"  ✓ {todo.get('content', 'Unknown task')}\n")
     
-    return formatted.strip()
+    return ''.join(parts).strip()
+
+ATTACHMENT_CHUNK_SIZE = 128*1024  # Read size for attachment downloads
 
 async def download_and_read_attachment(attachment: discord.Attachment) -> str:
     """Download and read the content of a Discord attachment"""
     try:
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{attachment.filename}") as temp_file:
-            temp_path = temp_file.name
-        
-        # Download the attachment
-        async with aiohttp.ClientSession() as session:
-            async with session.get(attachment.url) as response:
-                if response.status == 200:
-                    content = await response.read()
-                    with open(temp_path, 'wb') as f:
-                        f.write(content)
-                else:
-                    return f"Error downloading {attachment.filename}: HTTP {response.status}"
+        # Download the attachment over the bot's pooled session, straight into memory
+        content = bytearray()
+        async with bot.http_session.get(attachment.url) as response:
+            if response.status != 200:
+                return f"Error downloading {attachment.filename}: HTTP {response.status}"
+            async for chunk in response.content.iter_chunked(ATTACHMENT_CHUNK_SIZE):
+                content.extend(chunk)
         
         # Try to read as text file
         try:
-            with open(temp_path, 'r', encoding='utf-8') as f:
-                file_content = f.read()
-            
-            # Clean up temp file
-            os.unlink(temp_path)
-            
+            # Normalise newlines the way reading the file in text mode did
+            file_content = content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
             return f"**File: {attachment.filename}**\n```\n{file_content}\n```"
             
         except UnicodeDecodeError:
             # If it's not a text file, return file info
-            file_size = os.path.getsize(temp_path)
-            os.unlink(temp_path)
-            return f"**File: {attachment.filename}** (Binary file, {file_size} bytes) - Cannot display content as text"
+            return f"**File: {attachment.filename}** (Binary file, {len(content)} bytes) - Cannot display content as text"
             
     except Exception as e:
         logger.error(f"Error processing attachment {attachment.filename}: {e}")
         return f"Error processing {attachment.filename}: {str(e)}"
 
 async def send_long_message(ctx, message: str, max_length: int = 2000):
-    """Split and send long messages in chunks"""
-    if len(message) <= max_length:
-        await ctx.send(message)
-        return
+    """Split and send long messages in chunks, returning the last message sent"""
+    def split_text(text: str, max_len: int):
+        """Yield chunks of at most max_len chars, breaking at the last newline, else the last space"""
+        start = 0
+        text_length = len(text)
+        while text_length - start > max_len:
+            end = start + max_len
+            cut = text.rfind('\n', start, end + 1)
+            if cut <= start:
+                cut = text.rfind(' ', start, end + 1)
+            if cut <= start:
+                # No break point in range, hard cut
+                yield text[start:end]
+                start = end
+                continue
+            yield text[start:cut].rstrip()
+            start = cut + 1  # Skip the newline/space we split on
+        if start < text_length:
+            yield text[start:]
     
-    continuation_prefix = ""
+    # Chunks must arrive in order, so they are sent one at a time while holding the
+    # channel's lock; concurrent senders (e.g. the stream flusher) can't interleave
+    async with _channel_send_locks[ctx.channel.id]:
+        if len(message) <= max_length:
+            return await ctx.send(message)
+        
+        last_message = None
+        for chunk in split_text(message, max_length):
+            if chunk.strip():
+                last_message = await ctx.send(chunk)
+        return last_message
+
+CLAUDE_PIPE_SIZE = 1024*1024  # OS buffer for the CLI's stdout pipe (Linux default is 64KB)
+
+async def _spawn_claude_process(cmd: list):
+    """Start the streaming Claude CLI; returns (process, stdout reader, stdout transport)
     
-    def split_text(text: str, max_len: int) -> list:
-        """Recursively split text into chunks that fit within max_len"""
-        if len(text) <= max_len:
-            return [text]
-        
-        # Try to split by lines first
-        lines = text.split('\n')
-        if len(lines) > 1:
-            chunks = []
-            current = ""
-            
-            for line in lines:
-                test_line = current + line + "\n" if current else line + "\n"
-                if len(test_line) <= max_len:
-                    current = test_line
-                else:
-                    if current:
-                        chunks.append(current.rstrip())
-                        current = line + "\n"
-                        if len(current) > max_len:
-                            # Line itself is too long, split by words
-                            chunks.extend(split_text(line, max_len))
-                            current = ""
-                    else:
-                        # Single line too long, split by words
-                        chunks.extend(split_text(line, max_len))
-            
-            if current:
-                chunks.append(current.rstrip())
-            
-            return chunks
-        
-        # Split by words
-        words = text.split(' ')
-        if len(words) > 1:
-            chunks = []
-            current = ""
-            
-            for word in words:
-                test_text = current + word + " " if current else word + " "
-                if len(test_text) <= max_len:
-                    current = test_text
-                else:
-                    if current:
-                        chunks.append(current.rstrip())
-                        current = word + " "
-                        if len(current) > max_len:
-                            # Single word too long, truncate it
-                            chunks.append(word[:max_len-3] + "...")
-                            current = ""
-                    else:
-                        # Single word too long, truncate it
-                        chunks.append(word[:max_len-3] + "...")
-            
-            if current:
-                chunks.append(current.rstrip())
-            
-            return chunks
-        
-        # Single word/text too long, truncate
-        return [text[:max_len-3] + "..."]
+    On Linux stdout is a pipe created here and enlarged with F_SETPIPE_SZ before the
+    CLI starts, so output bursts don't stall it. asyncio's own subprocess pipes can't
+    be relied on for this: uvloop hands the child a socketpair instead of a pipe.
+    The transport is None when asyncio owns stdout, otherwise the caller closes it.
+    """
+    options = dict(
+        stdin=asyncio.subprocess.DEVNULL,  # The prompt is passed with --print; stdin just reads EOF
+        stderr=asyncio.subprocess.PIPE,
+        limit=1024*1024*32,  # 32MB limit for a single stream-json line
+        start_new_session=True  # Own process group, so stopping it also stops its children
+    )
+    set_pipe_size = getattr(fcntl, 'F_SETPIPE_SZ', None)
+    if set_pipe_size is None:
+        # Not Linux - use asyncio's default pipe
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, **options)
+        return process, process.stdout, None
     
-    # Split the message into chunks
-    chunks = split_text(message, max_length)
+    read_fd, write_fd = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(write_fd, set_pipe_size, CLAUDE_PIPE_SIZE)
+        except OSError as e:
+            # Above /proc/sys/fs/pipe-max-size; the default buffer still works
+            logger.warning(f"Could not enlarge Claude CLI stdout pipe: {e}")
+        process = await asyncio.create_subprocess_exec(*cmd, stdout=write_fd, **options)
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)  # The CLI holds its own copy; closing ours lets EOF through
     
-    # Send all chunks
-    for chunk in chunks:
-        await ctx.send(chunk)
+    stdout = asyncio.StreamReader(limit=options['limit'])
+    transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(stdout), os.fdopen(read_fd, 'rb', buffering=0)
+    )
+    return process, stdout, transport
+
+def _signal_claude_process(process, kill: bool = False):
+    """Terminate or kill the Claude CLI together with any children it started
+    
+    The CLI runs in its own session (start_new_session=True), so on POSIX its
+    process group id is its pid and the whole group can be signalled at once.
+    """
+    if os.name != 'posix':
+        if kill:
+            process.kill()
+        else:
+            process.terminate()
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+    except ProcessLookupError:
+        pass  # Already gone
+
+def _allowed_tools_arg(tools: list) -> str:
+    """Get the --allowedTools value, reusing the prebuilt one for the default tool list"""
+    if tools is CLAUDE_TOOLS:
+        return _CLAUDE_TOOLS_ARG
+    return ",".join(tools)
 
 class ActivityTimeout:
     """Manages timeout that resets on activity"""
-    def __init__(self, base_timeout: float = 300.0):
+    def __init__(self, base_timeout: float = 300.0, loop: Optional[asyncio.AbstractEventLoop] = None):
         self.base_timeout = base_timeout
-        self.last_activity = asyncio.get_event_loop().time()
-        self.start_time = self.last_activity
+        self._loop = loop  # Looked up once, since reset() runs for every stream line
+        self._timeout = None
+        
+    def scope(self) -> asyncio.Timeout:
+        """Create the asyncio.timeout() context that reset() pushes back"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        self._timeout = asyncio.timeout(self.base_timeout)
+        return self._timeout
         
     def reset(self):
         """Reset the activity timeout"""
-        self.last_activity = asyncio.get_event_loop().time()
+        if self._timeout is None or self._timeout.when() is None or self._timeout.expired():
+            return
+        deadline = self._loop.time() + self.base_timeout
+        # Rescheduling re-arms a timer, so only move the deadline once it has drifted a second
+        if deadline - self._timeout.when() >= 1.0:
+            self._timeout.reschedule(deadline)
+
+class StreamState:
+    """Mutable state shared by the stream-json handlers during one Claude call"""
+    def __init__(self, ctx, response_parts: list, activity_timeout: ActivityTimeout):
+        self.ctx = ctx
+        self.loop = asyncio.get_running_loop()
+        # Assistant text is kept as fragments in response_parts and only joined when sent
+        self.response_parts = response_parts
+        self.activity_timeout = activity_timeout
+        self.sent_parts = 0  # Track how many fragments we've already sent
+        self.pending_chars = 0  # Text received since the last flush
+        self.pending_deadline = None  # When pending text must be flushed at the latest
+        # Discord messages waiting to be sent, in stream order
+        self.outbox = asyncio.Queue()
+        self.finished = False  # Set by a handler to stop processing the stream
+        self._tasks = []
+        
+    def start(self):
+        """Start the background tasks that send queued messages and flush text on time"""
+        self._tasks = [
+            asyncio.create_task(self.drain_outbox()),
+            asyncio.create_task(self.flush_on_deadline()),
+        ]
         
-    def time_remaining(self) -> float:
-        """Get remaining time before timeout"""
-        current_time = asyncio.get_event_loop().time()
-        elapsed_since_activity = current_time - self.last_activity
-        return max(0, self.base_timeout - elapsed_since_activity)
+    def stop(self):
+        """Cancel the background tasks"""
+        for task in self._tasks:
+            task.cancel()
+        
+    def post(self, message: str):
+        """Queue a message for Discord without waiting for it to be sent"""
+        # Text that arrived before this message has to go out first
+        self.flush_pending_text()
+        self.outbox.put_nowait(message)
+        
+    def flush_pending_text(self):
+        """Queue assistant text that hasn't been sent to Discord yet"""
+        flush_end = len(self.response_parts)
+        if self.sent_parts == flush_end:
+            return
+        self.pending_chars = 0
+        self.pending_deadline = None
+        new_text = ''.join(self.response_parts[self.sent_parts:flush_end])
+        
+        # Always send only new text, never edit
+        if new_text.strip():
+            self.outbox.put_nowait(new_text)
+            self.sent_parts = flush_end
+        
+    async def drain_outbox(self):
+        """Send queued messages in order, so Discord latency never stalls stream parsing"""
+        while True:
+            message = await self.outbox.get()
+            try:
+                await send_long_message(self.ctx, message)
+            except Exception as e:
+                logger.error(f"Error sending Discord message: {e}")
+            finally:
+                self.outbox.task_done()
+                
+    async def drain(self):
+        """Wait until every queued message has been sent"""
+        await self.outbox.join()
+        
+    async def flush_on_deadline(self):
+        """Flush pending text once it has waited long enough, independent of the read loop"""
+        while True:
+            await asyncio.sleep(STREAM_FLUSH_INTERVAL)
+            if self.pending_deadline is not None and self.loop.time() >= self.pending_deadline:
+                self.flush_pending_text()
+
+# Tool input previews: tool name -> (input key the preview needs, formatter)
+_TOOL_PREVIEWS = {
+    "Bash": ("command", lambda i: f"Command: `{i['command'][:100]}`"),
+    # For Read, just show filename
+    "Read": ("file_path", lambda i: f"📄 `{i['file_path'].rsplit('/', 1)[-1]}`"),
+    "Write": ("file_path", lambda i: f"File: `{i['file_path']}`"),
+    "Edit": ("file_path", lambda i: f"File: `{i['file_path']}` (editing `{i.get('old_string', '')[:50]}...`)"),
+    # For MultiEdit, show file and number of edits
+    "MultiEdit": ("file_path", lambda i: f"File: `{i['file_path']}` ({len(i.get('edits', []))} edits)"),
+    # For Task, show full prompt without truncation
+    "Task": ("prompt", lambda i: f"Prompt: {i['prompt']}"),
+    "TodoRead": (None, lambda i: "📋 Reading todo list"),
+    "TodoWrite": (None, lambda i: f"📋 Updating todo list ({len(i.get('todos', []))} items)"),
+}
+
+def _tool_input_preview(tool_name: str, tool_input: dict) -> str:
+    """Describe a tool call's input in one line for the tool-use message"""
+    required_key, formatter = _TOOL_PREVIEWS.get(tool_name, (None, None))
+    if formatter is not None and (required_key is None or required_key in tool_input):
+        return formatter(tool_input)
+    if "path" in tool_input:
+        return f"Path: `{tool_input['path']}`"
+    
+    # Show first few key-value pairs
+    preview_items = []
+    for k, v in list(tool_input.items())[:2]:
+        if isinstance(v, str) and len(v) > 50:
+            v = v[:50] + "..."
+        preview_items.append(f"{k}: `{v}`")
+    return ", ".join(preview_items)
+
+async def _handle_assistant(data: dict, state: StreamState):
+    """Handle assistant messages - extract text and stream it"""
+    if "message" not in data:
+        return
+    ctx = state.ctx
+    
+    for block in data["message"].get("content", []):
+        match block:
+            case {"type": "text", "text": text} if text:
+                state.response_parts.append(text)
+                
+                # Batch streamed text: flush on size here, on time from the flusher task
+                if ctx:
+                    state.pending_chars += len(text)
+                    if state.pending_deadline is None:
+                        state.pending_deadline = state.loop.time() + STREAM_FLUSH_DELAY
+                    if state.pending_chars >= STREAM_BATCH_CHARS:
+                        state.flush_pending_text()
+            
+            case {"type": "thinking", "thinking": thinking_content} if thinking_content and ctx:
+                # Display thinking content, truncated if too long for Discord
+                if len(thinking_content) > 1800:
+                    thinking_preview = thinking_content[:1800] + "..."
+                else:
+                    thinking_preview = thinking_content
+                
+                thinking_msg = f"💭 **Claude's Thinking:**\n```\n{thinking_preview}\n```"
+                state.post(thinking_msg)
+            
+            case {"type": "tool_use", "name": tool_name, "input": tool_input}:
+                # Format tool input nicely
+                input_preview = ""
+                if isinstance(tool_input, dict):
+                    input_preview = _tool_input_preview(tool_name, tool_input)
+                    
+                    # Also send the formatted todo list immediately for TodoWrite
+                    if tool_name == "TodoWrite" and ctx:
+                        todos = tool_input.get('todos', [])
+                        if todos:
+                            formatted_todos = format_todos_list(todos)
+                            state.post(formatted_todos)
+                            state.activity_timeout.reset()  # Reset timeout
+            
+                # Special formatting for Read tool
+                if tool_name == "Read":
+                    tool_msg = f"🔧 **Reading:** {input_preview}"
+                else:
+                    tool_msg = f"🔧 **Tool Use:** {tool_name}"
+                    if input_preview:
+                        tool_msg += f"\n   {input_preview}"
+            
+                if ctx:
+                    state.post(tool_msg)
+
+async def _handle_user(data: dict, state: StreamState):
+    """Handle user messages - show what was sent to Claude and tool results"""
+    ctx = state.ctx
+    user_msg = data.get('message', {})
+    message_content = ""
+    
+    match user_msg.get('content'):
+        case list() as blocks:
+            for block in blocks:
+                match block:
+                    case {'type': 'text', 'text': text} if text:
+                        message_content = f"**User:** {text}"
+                    case {'type': 'tool_result'}:
+                        # Handle tool results
+                        is_error = block.get('is_error', False)
+                        
+                        match block.get('content'):
+                            case str() as content:
+                                pass
+                            case list() as items:
+                                # Task/subagent results arrive as a list of content blocks
+                                content = "\n".join(
+                                    item['text'] for item in items
+                                    if isinstance(item, dict) and item.get('type') == 'text' and isinstance(item.get('text'), str)
+                                )
+                            case _:
+                                # No content - still report the status line
+                                content = ""
+                        
+                        # Check if this is a read command result (very verbose)
+                        # Look for previous tool use to determine tool name
+                        is_read_result = False
+                        is_todo_result = False
+                
+                        status = "❌" if is_error else "✅"
+                        result_preview = ""
+                
+                        if content:
+                            # Check if content looks like a Read tool result (has line numbers)
+                            if '→' in content and any(line.strip().startswith(f'{i}→') for i in range(1, 20) for line in content.split('\n')[:20]):
+                                is_read_result = True
+                    
+                            if is_read_result:
+                                # For Read results, just show a summary
+                                lines = content.split('\n')
+                                line_count = len([l for l in lines if '→' in l])
+                                # Try to extract filename from first few lines
+                                filename = "file"
+                                for line in lines[:5]:
+                                    if any(ext in line.lower() for ext in ['.py', '.js', '.ts', '.txt', '.md', '.json', '.yaml', '.yml', '.xml', '.html', '.css']):
+                                        # Extract potential filename
+                                        parts = line.split()
+                                        for part in parts:
+                                            if any(ext in part.lower() for ext in ['.py', '.js', '.ts', '.txt', '.md', '.json', '.yaml', '.yml', '.xml', '.html', '.css']):
+                                                filename = part.split('/')[-1]  # Get just the filename
+                                                break
+                                        break
+                                result_preview = f"📄 Read {filename} ({line_count} lines)"
+                            else:
+                                # Multiple ways to detect todo content
+                                if any(indicator in content.lower() for indicator in [
+                                    'todo list', 'status":"', 'priority":"', '"content":"',
+                                    'in_progress', 'pending', 'completed', 'remember to continue'
+                                ]):
+                                    is_todo_result = True
+                        
+                                if is_todo_result:
+                                    result_preview = format_todo_content(content)
+                                else:
+                                    # For other tool results, truncate if too long
+                                    if len(content) > 1000:
+                                        result_preview = content[:1000] + "\n... (truncated)"
+                                    else:
+                                        result_preview = content
+                            
+                                    # Format as code block if it looks like output
+                                    if '\n' in result_preview or any(c in result_preview for c in ['/', '\\', '$', '>']):
+                                        result_preview = f"```\n{result_preview}\n```"
+                                    else:
+                                        result_preview = f"`{result_preview}`"
+                
+                        tool_result_msg = f"{status} **Tool Result**"
+                        if result_preview:
+                            tool_result_msg += f"\n{result_preview}"
+                
+                        if ctx:
+                            if is_read_result:
+                                # Don't send read results at all - they're handled in the summary above
+                                pass
+                            elif is_todo_result:
+                                # Always send todo results, they're important for user visibility
+                                state.post(tool_result_msg)
+                            else:
+                                # Send other tool results with full content (but truncated)
+                                state.post(tool_result_msg)
         
-    def is_expired(self) -> bool:
-        """Check if timeout has expired"""
-        return self.time_remaining() <= 0
+        case str() as text:
+            message_content = f"**User:** {text}"
+    
+    if message_content and ctx:
+        state.post(message_content)
+
+async def _handle_system(data: dict, state: StreamState):
+    """Handle system messages - show progress info"""
+    subtype = data.get("subtype", "")
+    message_content = ""
+    if subtype == "thinking":
+        message_content = "🤔 *Claude is thinking...*"
+    elif subtype == "tool_use":
+        tool_name = data.get("tool_name", "unknown")
+        message_content = f"🔧 *Using tool: {tool_name}*"
+    elif subtype in ["tool_result", "tool_error"]:
+        tool_name = data.get("tool_name", "unknown")
+        status = "✅" if subtype == "tool_result" else "❌"
+        
+        # For Read tool results, show line count
+        if tool_name == "Read" and subtype == "tool_result":
+            # Try to get result content from the data
+            result_content = data.get("content", "")
+            if result_content and '→' in result_content:
+                lines = result_content.split('\n')
+                line_count = len([l for l in lines if '→' in l])
+                message_content = f"{status} *Read completed ({line_count} lines)*"
+            else:
+                message_content = f"{status} *Read completed*"
+        else:
+            message_content = f"{status} *Tool {tool_name} completed*"
+    
+    if message_content and state.ctx:
+        state.post(message_content)
+
+async def _handle_result(data: dict, state: StreamState):
+    """Handle the result message - show completion and final message update"""
+    ctx = state.ctx
+    num_turns = data.get('num_turns', 0)
+    is_error = data.get('is_error', False)
+    result_content = data.get('result', '')
+    
+    # Check for usage limit error
+    if is_error and "Claude AI usage limit reached|" in result_content:
+        formatted_error = format_usage_limit_message(result_content)
+        if ctx:
+            state.post(formatted_error)
+        logger.info(f"Usage limit reached: {result_content}")
+        state.finished = True  # Don't process further
+        return
+    
+    # Any remaining text is flushed ahead of the completion message by post()
+    message_content = f"✨ *Conversation completed ({num_turns} turns)*"
+    if ctx:
+        state.post(message_content)
+    logger.info(f"Got result message with {num_turns} turns")
+
+# stream-json message type -> handler
+_STREAM_HANDLERS = {
+    "assistant": _handle_assistant,
+    "user": _handle_user,
+    "system": _handle_system,
+    "result": _handle_result,
+}
 
 async def call_claude_enhanced(prompt: str, system_prompt: str = None, tools: list = None, 
                              continue_conversation: bool = False, resume_session: str = None, ctx=None) -> str:
     """Enhanced Claude CLI call that handles streaming responses properly"""
     global current_claude_process, current_claude_channel
     try:
-        cmd = [
-            CLAUDE_CLI_PATH,
-            "--output-format", "stream-json",
-            "--verbose",
-            "--print", prompt
-        ]
+        cmd = [*_BASE_CMD, "--print", prompt]
         
         if system_prompt:
             cmd.extend(["--system-prompt", system_prompt])
             
         if tools:
-            cmd.extend(["--allowedTools", ",".join(tools)])
+            cmd.extend(["--allowedTools", _allowed_tools_arg(tools)])
             
         if continue_conversation:
             cmd.append("--continue")
@@ -336,13 +823,7 @@ async def call_claude_enhanced(prompt: str, system_prompt: str = None, tools: li
         
         # Run subprocess with streaming and better error handling
         try:
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                limit=1024*1024*10  # 10MB buffer limit
-            )
+            process, stdout, stdout_transport = await _spawn_claude_process(cmd)
             # Store process reference globally for stop command
             current_claude_process = process
             current_claude_channel = ctx.channel if ctx else None
@@ -350,518 +831,113 @@ async def call_claude_enhanced(prompt: str, system_prompt: str = None, tools: li
             logger.error(f"Failed to start Claude CLI process: {e}")
             return f"Error: Failed to start Claude CLI: {str(e)}"
         
-        # Send empty input to stdin and close it
-        if process.stdin:
-            process.stdin.write(b'\n')
-            await process.stdin.drain()
-            process.stdin.close()
-            await process.stdin.wait_closed()
-        
         response_parts = []
-        error_parts = []
+        error_parts = deque(maxlen=256)  # Only the stderr tail is needed for error reports
         
         # Create activity timeout tracker
         activity_timeout = ActivityTimeout(300.0)  # 5 minute base timeout
         
         async def read_stdout():
             """Read and parse stdout stream continuously with true streaming"""
-            last_send_time = asyncio.get_event_loop().time()
-            accumulated_text = ""
-            current_assistant_message = ""
-            sent_text_length = 0  # Track how much text we've already sent
-            last_discord_message = None
-            partial_line = ""
-            tools_used_after_text = False  # Track if tools were used after text was sent
+            if stdout is None:
+                return
             
-            while True:
+            state = StreamState(ctx, response_parts, activity_timeout)
+            if ctx:
+                state.start()
+            
+            try:
                 try:
-                    if process.stdout is None:
-                        break
-                    
-                    # Read smaller chunks for true streaming with timeout
-                    try:
-                        chunk = await asyncio.wait_for(process.stdout.read(1024), timeout=5.0)
-                    except asyncio.TimeoutError:
-                        # No data for 5 seconds, check if process is still alive
-                        if process.returncode is not None:
-                            break
-                        continue
-                    except Exception as e:
-                        logger.error(f"Error reading stdout chunk: {e}")
-                        break
-                    
-                    if not chunk:
-                        # Stream ended - check if process is still running
-                        if process.returncode is not None:
-                            # Process has terminated - send any remaining text
-                            if current_assistant_message and ctx:
-                                if last_discord_message and not tools_used_after_text:
-                                    # Send remaining text that hasn't been sent yet
-                                    remaining_text = current_assistant_message[sent_text_length:]
-                                    if remaining_text.strip():
-                                        await send_long_message(ctx, remaining_text)
-                                        sent_text_length = len(current_assistant_message)
-                                        activity_timeout.reset()  # Reset timeout
-                                else:
-                                    # Send only remaining text if tools were used
-                                    if tools_used_after_text and sent_text_length < len(current_assistant_message):
-                                        remaining_text = current_assistant_message[sent_text_length:]
-                                        if remaining_text.strip():
-                                            await send_long_message(ctx, remaining_text)
-                                            sent_text_length = len(current_assistant_message)  # Update tracking
-                                            last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                    elif not tools_used_after_text and sent_text_length == 0:
-                                        # Send full message only if nothing has been sent yet
-                                        await send_long_message(ctx, current_assistant_message)
-                                        sent_text_length = len(current_assistant_message)  # Update tracking
-                                        last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                    elif not tools_used_after_text and sent_text_length < len(current_assistant_message):
-                                        # Send only remaining text if some was already sent
-                                        remaining_text = current_assistant_message[sent_text_length:]
-                                        if remaining_text.strip():
-                                            await send_long_message(ctx, remaining_text)
-                                            sent_text_length = len(current_assistant_message)  # Update tracking
-                                            last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                            elif accumulated_text and ctx:
-                                await send_long_message(ctx, accumulated_text)
-                                last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                            break
-                        # Process still running, wait a bit and continue
-                        await asyncio.sleep(0.1)
-                        continue
-                    
-                    chunk_text = chunk.decode('utf-8', errors='ignore')
-                    
-                    # Log the raw unparsed stream chunk
-                    claude_stream_logger.info(f"RAW_CHUNK: {repr(chunk_text)}")
-                    
-                    partial_line += chunk_text
-                    
-                    # Process complete lines
-                    while '\n' in partial_line:
-                        line, partial_line = partial_line.split('\n', 1)
+                    # StreamReader yields complete lines and waits on EOF itself, so no
+                    # manual line buffer or per-read timeout is needed
+                    async for line in stdout:
+                        activity_timeout.reset()
                         
-                        # Log every complete line (unparsed)
-                        claude_stream_logger.info(f"RAW_LINE: {repr(line)}")
+                        # Record every complete line (unparsed) when CLAUDE_STREAM_LOG=DEBUG
+                        if raw_stream_recorder is not None:
+                            raw_stream_recorder.write(line)
                         
-                        line = line.strip()
-                        if not line:
+                        # Both JSON parsers accept the trailing newline, so only whitespace-only lines are dropped
+                        if line.isspace():
                             continue
-                            
+                        
+                        # Skip events we never display (e.g. the large init event) without parsing them
+                        if line.startswith(_IGNORED_LINE_PREFIXES):
+                            continue
+                        
                         try:
-                            data = json.loads(line)
-                            msg_type = data.get("type")
-                            
-                            if msg_type == "assistant" and "message" in data:
-                                # Handle assistant messages - extract text and stream it
-                                for block in data["message"].get("content", []):
-                                    if block.get("type") == "text":
-                                        text = block.get("text", "")
-                                        if text:
-                                            current_assistant_message += text
-                                            response_parts.append(text)
-                                            
-                                            # Stream assistant responses in real-time
-                                            if ctx:
-                                                current_time = asyncio.get_event_loop().time()
-                                                
-                                                # Update Discord message every 1 second or every 500 chars
-                                                if ((current_time - last_send_time >= 1.0) or 
-                                                    (len(current_assistant_message) % 500 < len(text))):
-                                                    
-                                                    message_to_send = current_assistant_message[:2000]  # Discord limit
-                                                    if len(current_assistant_message) > 2000:
-                                                        message_to_send = message_to_send[:-3] + "..."
-                                                    
-                                                    try:
-                                                        # Always send only new text, never edit
-                                                        new_text = current_assistant_message[sent_text_length:]
-                                                        if new_text.strip():
-                                                            last_discord_message = await send_long_message(ctx, new_text)
-                                                            sent_text_length = len(current_assistant_message)
-                                                            tools_used_after_text = False  # Reset for future text
-                                                            last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                                    except discord.errors.HTTPException:
-                                                        # If edit fails, send new message
-                                                        if tools_used_after_text:
-                                                            new_text = current_assistant_message[sent_text_length:]
-                                                            if new_text.strip():
-                                                                last_discord_message = await ctx.send(new_text[:2000])
-                                                                sent_text_length = len(current_assistant_message)
-                                                                last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                                        else:
-                                                            last_discord_message = await ctx.send(message_to_send)
-                                                            sent_text_length = len(current_assistant_message)
-                                                            last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                                        tools_used_after_text = False
-                                                    except Exception as e:
-                                                        logger.error(f"Error updating Discord message: {e}")
-                                                    
-                                                    last_send_time = current_time
-                                    
-                                    elif block.get("type") == "thinking":
-                                        # Display thinking content
-                                        thinking_content = block.get("thinking", "")
-                                        if thinking_content and ctx:
-                                            # Truncate thinking if too long for Discord
-                                            if len(thinking_content) > 1800:
-                                                thinking_preview = thinking_content[:1800] + "..."
-                                            else:
-                                                thinking_preview = thinking_content
-                                            
-                                            thinking_msg = f"💭 **Claude's Thinking:**\n```\n{thinking_preview}\n```"
-                                            await ctx.send(thinking_msg)
-                                            last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                    
-                                    elif block.get("type") == "tool_use":
-                                        # Mark that tools are being used after text was sent
-                                        if last_discord_message:
-                                            tools_used_after_text = True
-                                        
-                                        # Display tool use information
-                                        tool_name = block.get("name", "unknown")
-                                        tool_input = block.get("input", {})
-                                        tool_id = block.get("id", "")[:8]  # Show first 8 chars of ID
-                                        
-                                        # Store tool info for later use in results
-                                        current_tool_info = {
-                                            'name': tool_name,
-                                            'input': tool_input,
-                                            'id': tool_id
-                                        }
-                                        
-                                        # Format tool input nicely
-                                        input_preview = ""
-                                        if isinstance(tool_input, dict):
-                                            # Show key details based on tool type
-                                            if tool_name == "Bash" and "command" in tool_input:
-                                                input_preview = f"Command: `{tool_input['command'][:100]}`"
-                                            elif tool_name == "Read" and "file_path" in tool_input:
-                                                # For Read, just show filename
-                                                filename = tool_input['file_path'].split('/')[-1]
-                                                input_preview = f"📄 `{filename}`"
-                                            elif tool_name == "Write" and "file_path" in tool_input:
-                                                input_preview = f"File: `{tool_input['file_path']}`"
-                                            elif tool_name == "Edit" and "file_path" in tool_input:
-                                                old_str = tool_input.get('old_string', '')[:50]
-                                                input_preview = f"File: `{tool_input['file_path']}` (editing `{old_str}...`)"
-                                            elif tool_name == "Task" and "prompt" in tool_input:
-                                                # For Task, show full prompt without truncation
-                                                input_preview = f"Prompt: {tool_input['prompt']}"
-                                            elif tool_name in ["TodoRead", "TodoWrite"]:
-                                                # For Todo tools, show brief description and actual content for TodoWrite
-                                                if tool_name == "TodoRead":
-                                                    input_preview = "📋 Reading todo list"
-                                                else:
-                                                    todos = tool_input.get('todos', [])
-                                                    todos_count = len(todos)
-                                                    input_preview = f"📋 Updating todo list ({todos_count} items)"
-                                                    
-                                                    # Also send the formatted todo list immediately for TodoWrite
-                                                    if todos and ctx:
-                                                        formatted_todos = format_todos_list(todos)
-                                                        await ctx.send(formatted_todos)
-                                                        activity_timeout.reset()  # Reset timeout
-                                            elif tool_name == "MultiEdit" and "file_path" in tool_input:
-                                                # For MultiEdit, show file and number of edits
-                                                edits_count = len(tool_input.get('edits', []))
-                                                input_preview = f"File: `{tool_input['file_path']}` ({edits_count} edits)"
-                                            elif "path" in tool_input:
-                                                input_preview = f"Path: `{tool_input['path']}`"
-                                            else:
-                                                # Show first few key-value pairs
-                                                preview_items = []
-                                                for k, v in list(tool_input.items())[:2]:
-                                                    if isinstance(v, str) and len(v) > 50:
-                                                        # Don't truncate Task prompts
-                                                        if tool_name == "Task" and k == "prompt":
-                                                            preview_items.append(f"{k}: {v}")
-                                                        else:
-                                                            v = v[:50] + "..."
-                                                            preview_items.append(f"{k}: `{v}`")
-                                                    else:
-                                                        preview_items.append(f"{k}: `{v}`")
-                                                input_preview = ", ".join(preview_items)
-                                        
-                                        # Special formatting for Read tool
-                                        if tool_name == "Read":
-                                            tool_msg = f"🔧 **Reading:** {input_preview}"
-                                        else:
-                                            tool_msg = f"🔧 **Tool Use:** {tool_name}"
-                                            if input_preview:
-                                                tool_msg += f"\n   {input_preview}"
-                                        
-                                        if ctx:
-                                            await ctx.send(tool_msg)
-                                            last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                        
-                            elif msg_type == "user":
-                                # User messages - show what was sent to Claude and tool results
-                                user_msg = data.get('message', {})
-                                message_content = ""
-                                
-                                if isinstance(user_msg.get('content'), list):
-                                    for block in user_msg['content']:
-                                        if block.get('type') == 'text':
-                                            text = block.get('text', '')
-                                            if text:
-                                                message_content = f"**User:** {text}"
-                                        elif block.get('type') == 'tool_result':
-                                            # Handle tool results
-                                            tool_use_id = block.get('tool_use_id', '')[:8]
-                                            content = block.get('content', '')
-                                            is_error = block.get('is_error', False)
-                                            
-                                            # Check if this is a read command result (very verbose)
-                                            # Look for previous tool use to determine tool name
-                                            is_read_result = False
-                                            
-                                            status = "❌" if is_error else "✅"
-                                            result_preview = ""
-                                            
-                                            if content:
-                                                # Check if content looks like a Read tool result (has line numbers)
-                                                if '→' in content and any(line.strip().startswith(f'{i}→') for i in range(1, 20) for line in content.split('\n')[:20]):
-                                                    is_read_result = True
-                                                
-                                                if is_read_result:
-                                                    # For Read results, just show a summary
-                                                    lines = content.split('\n')
-                                                    line_count = len([l for l in lines if '→' in l])
-                                                    # Try to extract filename from first few lines
-                                                    filename = "file"
-                                                    for line in lines[:5]:
-                                                        if any(ext in line.lower() for ext in ['.py', '.js', '.ts', '.txt', '.md', '.json', '.yaml', '.yml', '.xml', '.html', '.css']):
-                                                            # Extract potential filename
-                                                            parts = line.split()
-                                                            for part in parts:
-                                                                if any(ext in part.lower() for ext in ['.py', '.js', '.ts', '.txt', '.md', '.json', '.yaml', '.yml', '.xml', '.html', '.css']):
-                                                                    filename = part.split('/')[-1]  # Get just the filename
-                                                                    break
-                                                            break
-                                                    result_preview = f"📄 Read {filename} ({line_count} lines)"
-                                                else:
-                                                    # Check if this is a todo result and format it nicely
-                                                    is_todo_result = False
-                                                    
-                                                    # Multiple ways to detect todo content
-                                                    if any(indicator in content.lower() for indicator in [
-                                                        'todo list', 'status":"', 'priority":"', '"content":"',
-                                                        'in_progress', 'pending', 'completed', 'remember to continue'
-                                                    ]):
-                                                        is_todo_result = True
-                                                    
-                                                    if is_todo_result:
-                                                        result_preview = format_todo_content(content)
-                                                    else:
-                                                        # For other tool results, truncate if too long
-                                                        if len(content) > 1000:
-                                                            result_preview = content[:1000] + "\n... (truncated)"
-                                                        else:
-                                                            result_preview = content
-                                                        
-                                                        # Format as code block if it looks like output
-                                                        if '\n' in result_preview or any(c in result_preview for c in ['/', '\\', '$', '>']):
-                                                            result_preview = f"```\n{result_preview}\n```"
-                                                        else:
-                                                            result_preview = f"`{result_preview}`"
-                                            
-                                            tool_result_msg = f"{status} **Tool Result**"
-                                            if result_preview:
-                                                tool_result_msg += f"\n{result_preview}"
-                                            
-                                            if ctx:
-                                                if is_read_result:
-                                                    # Don't send read results at all - they're handled in the summary above
-                                                    pass
-                                                elif is_todo_result:
-                                                    # Always send todo results, they're important for user visibility
-                                                    await send_long_message(ctx, tool_result_msg)
-                                                    last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                                else:
-                                                    # Send other tool results with full content (but truncated)
-                                                    await send_long_message(ctx, tool_result_msg)
-                                                    last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                
-                                elif isinstance(user_msg.get('content'), str):
-                                    message_content = f"**User:** {user_msg['content']}"
-                                
-                                if message_content and ctx:
-                                    await ctx.send(message_content)
-                                    last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                
-                            elif msg_type == "system":
-                                # System messages - show progress info
-                                subtype = data.get("subtype", "")
-                                message_content = ""
-                                if subtype == "thinking":
-                                    message_content = "🤔 *Claude is thinking...*"
-                                elif subtype == "tool_use":
-                                    tool_name = data.get("tool_name", "unknown")
-                                    message_content = f"🔧 *Using tool: {tool_name}*"
-                                elif subtype in ["tool_result", "tool_error"]:
-                                    tool_name = data.get("tool_name", "unknown")
-                                    status = "✅" if subtype == "tool_result" else "❌"
-                                    
-                                    # For Read tool results, show line count
-                                    if tool_name == "Read" and subtype == "tool_result":
-                                        # Try to get result content from the data
-                                        result_content = data.get("content", "")
-                                        if result_content and '→' in result_content:
-                                            lines = result_content.split('\n')
-                                            line_count = len([l for l in lines if '→' in l])
-                                            message_content = f"{status} *Read completed ({line_count} lines)*"
-                                        else:
-                                            message_content = f"{status} *Read completed*"
-                                    else:
-                                        message_content = f"{status} *Tool {tool_name} completed*"
-                                
-                                if message_content and ctx:
-                                    await ctx.send(message_content)
-                                    last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                    
-                            elif msg_type == "result":
-                                # Result message - show completion and final message update
-                                num_turns = data.get('num_turns', 0)
-                                is_error = data.get('is_error', False)
-                                result_content = data.get('result', '')
-                                
-                                # Check for usage limit error
-                                if is_error and "Claude AI usage limit reached|" in result_content:
-                                    formatted_error = format_usage_limit_message(result_content)
-                                    if ctx:
-                                        await ctx.send(formatted_error)
-                                        last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                    logger.info(f"Usage limit reached: {result_content}")
-                                    return  # Don't process further
-                                
-                                # Send any remaining content that hasn't been sent yet
-                                if current_assistant_message and ctx:
-                                    if sent_text_length < len(current_assistant_message):
-                                        # There's new content to add
-                                        remaining_content = current_assistant_message[sent_text_length:]
-                                        if remaining_content.strip():
-                                            try:
-                                                await send_long_message(ctx, remaining_content)
-                                                sent_text_length = len(current_assistant_message)
-                                                last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                            except Exception as e:
-                                                logger.error(f"Error sending final message: {e}")
-                                
-                                message_content = f"✨ *Conversation completed ({num_turns} turns)*"
-                                if ctx:
-                                    await ctx.send(message_content)
-                                    last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                logger.info(f"Got result message with {num_turns} turns")
-                            
-                        except json.JSONDecodeError:
+                            data = json_loads(line)
+                        except JSONDecodeError:
                             # Non-JSON lines, might be progress info or partial JSON
-                            claude_stream_logger.info(f"NON_JSON_LINE: {repr(line)}")
+                            if claude_stream_logger.isEnabledFor(logging.INFO):
+                                claude_stream_logger.info(f"NON_JSON_LINE: {repr(line)}")
                             logger.debug(f"Non-JSON line: {line[:100]}...")
                             continue
                         
+                        if line.startswith(_ASSISTANT_LINE_PREFIX):
+                            handler = _handle_assistant
+                        else:
+                            handler = _STREAM_HANDLERS.get(data.get("type"))
+                        if handler is not None:
+                            await handler(data, state)
+                            if state.finished:
+                                break
                 except Exception as e:
-                    if "transport endpoint is not connected" in str(e).lower():
-                        # Process ended normally
-                        if current_assistant_message and ctx:
-                            if last_discord_message and not tools_used_after_text:
-                                # Send remaining text that hasn't been sent yet
-                                remaining_text = current_assistant_message[sent_text_length:]
-                                if remaining_text.strip():
-                                    await send_long_message(ctx, remaining_text)
-                                    sent_text_length = len(current_assistant_message)
-                                    last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                            else:
-                                # Send only remaining text if tools were used
-                                if tools_used_after_text and sent_text_length < len(current_assistant_message):
-                                    remaining_text = current_assistant_message[sent_text_length:]
-                                    if remaining_text.strip():
-                                        await send_long_message(ctx, remaining_text)
-                                        sent_text_length = len(current_assistant_message)  # Update tracking
-                                        last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                elif not tools_used_after_text and sent_text_length == 0:
-                                    # Send full message only if nothing has been sent yet
-                                    await send_long_message(ctx, current_assistant_message)
-                                    sent_text_length = len(current_assistant_message)  # Update tracking
-                                    last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                                elif not tools_used_after_text and sent_text_length < len(current_assistant_message):
-                                    # Send only remaining text if some was already sent
-                                    remaining_text = current_assistant_message[sent_text_length:]
-                                    if remaining_text.strip():
-                                        await send_long_message(ctx, remaining_text)
-                                        sent_text_length = len(current_assistant_message)  # Update tracking
-                                        last_activity_time = asyncio.get_event_loop().time()  # Reset timeout
-                        break
-                    logger.error(f"Error reading stdout: {e}")
-                    break
+                    # A disconnected transport just means the process ended normally
+                    if "transport endpoint is not connected" not in str(e).lower():
+                        logger.error(f"Error reading stdout: {e}")
+                        state.finished = True
+                
+                # Stream ended - send any remaining text, then wait for queued messages to go out
+                if ctx and not state.finished:
+                    state.flush_pending_text()
+                await state.drain()
+            finally:
+                state.stop()
         
         async def read_stderr():
-            """Read stderr stream with timeout"""
-            while True:
-                try:
-                    if process.stderr is None:
-                        break
-                    
-                    try:
-                        line = await asyncio.wait_for(process.stderr.readline(), timeout=5.0)
-                    except asyncio.TimeoutError:
-                        # No error data for 5 seconds, check if process is still alive
-                        if process.returncode is not None:
-                            break
-                        continue
-                    except Exception as e:
-                        logger.error(f"Error reading stderr line: {e}")
-                        break
-                    
-                    if not line:
-                        break
-                    stderr_text = line.decode().strip()
-                    
-                    # Log raw stderr
-                    claude_stream_logger.info(f"STDERR: {repr(stderr_text)}")
-                    
-                    error_parts.append(stderr_text)
-                except Exception as e:
-                    logger.error(f"Error reading stderr: {e}")
-                    break
-        
-        # Run both readers with dynamic timeout that resets on activity
-        async def run_with_activity_timeout():
-            readers_task = asyncio.create_task(asyncio.gather(read_stdout(), read_stderr()))
+            """Read stderr stream line by line until EOF"""
+            if process.stderr is None:
+                return
             
-            while not readers_task.done():
-                try:
-                    remaining_time = activity_timeout.time_remaining()
-                    if remaining_time <= 0:
-                        logger.error("Claude CLI process timed out due to inactivity (5 minutes)")
-                        readers_task.cancel()
-                        try:
-                            process.terminate()
-                            await asyncio.wait_for(process.wait(), timeout=5.0)
-                        except:
-                            process.kill()
-                        return "Error: Claude CLI process timed out due to inactivity"
-                    
-                    # Wait for completion or short timeout to check activity again
-                    await asyncio.wait_for(asyncio.shield(readers_task), timeout=min(remaining_time, 10.0))
-                    break
+            try:
+                async for line in process.stderr:
+                    activity_timeout.reset()
+                    # Never let a stray invalid byte end the reader and stop draining stderr
+                    stderr_text = line.decode('utf-8', errors='replace').strip()
                     
-                except asyncio.TimeoutError:
-                    # Check if process finished
-                    if process.returncode is not None:
-                        break
-                    # Continue loop to check activity timeout again
-                    continue
+                    # Log raw stderr, skipping the repr() when the stream log is turned down
+                    if claude_stream_logger.isEnabledFor(logging.INFO):
+                        claude_stream_logger.info(f"STDERR: {repr(stderr_text)}")
                     
-            return await readers_task
+                    error_parts.append(stderr_text)
+            except Exception as e:
+                logger.error(f"Error reading stderr: {e}")
         
+        # Run both readers with a timeout that resets whenever Claude produces output
         try:
-            await run_with_activity_timeout()
+            async with activity_timeout.scope():
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(read_stdout())
+                    tg.create_task(read_stderr())
+        except asyncio.CancelledError:
+            # The bot is shutting down; the CLI's own session won't get its signals
+            _signal_claude_process(process, kill=True)
+            raise
+        except TimeoutError:
+            logger.error("Claude CLI process timed out due to inactivity (5 minutes)")
+            try:
+                _signal_claude_process(process)
+                await asyncio.wait_for(process.wait(), timeout=5.0)
+            except:
+                _signal_claude_process(process, kill=True)
+            return "Error: Claude CLI process timed out due to inactivity"
         except Exception as e:
-            if "timed out" in str(e):
-                return str(e)
             logger.error(f"Error in activity timeout handler: {e}")
             return f"Error: {e}"
+        finally:
+            if stdout_transport is not None:
+                stdout_transport.close()
         
         # Wait for process to complete with timeout
         try:
@@ -869,7 +945,7 @@ async def call_claude_enhanced(prompt: str, system_prompt: str = None, tools: li
         except asyncio.TimeoutError:
             logger.error("Process did not terminate gracefully")
             try:
-                process.kill()
+                _signal_claude_process(process, kill=True)
                 await process.wait()
             except:
                 pass
@@ -899,19 +975,14 @@ async def call_claude_enhanced(prompt: str, system_prompt: str = None, tools: li
 async def call_claude_cli(prompt: str, system_prompt: str = None, tools: list = None, max_turns: int = 1) -> str:
     """Call Claude CLI directly as fallback"""
     try:
-        cmd = [
-            CLAUDE_CLI_PATH,
-            "--output-format", "stream-json",
-            "--verbose",
-            "--max-turns", str(max_turns),
-            "--print", prompt
-        ]
+        # Nothing is streamed here, so ask for a single JSON result instead of verbose stream-json
+        cmd = [CLAUDE_CLI_PATH, "--output-format", "json", "--max-turns", str(max_turns), "--print", prompt]
         
         if system_prompt:
             cmd.extend(["--system-prompt", system_prompt])
             
         if tools:
-            cmd.extend(["--allowedTools", ",".join(tools)])
+            cmd.extend(["--allowedTools", _allowed_tools_arg(tools)])
         
         # Run subprocess
         process = await asyncio.create_subprocess_exec(
@@ -923,23 +994,22 @@ async def call_claude_cli(prompt: str, system_prompt: str = None, tools: list =
         stdout, stderr = await process.communicate()
         
         if process.returncode != 0:
-            logger.error(f"Claude CLI error: {stderr.decode()}")
-            return f"Error: {stderr.decode()}"
+            stderr_text = stderr.decode('utf-8', errors='replace')
+            logger.error(f"Claude CLI error: {stderr_text}")
+            return f"Error: {stderr_text}"
         
-        # Parse JSON output
-        response_parts = []
-        for line in stdout.decode().strip().split('\n'):
-            if line.strip():
-                try:
-                    data = json.loads(line)
-                    if data.get("type") == "assistant" and "message" in data:
-                        for block in data["message"].get("content", []):
-                            if block.get("type") == "text":
-                                response_parts.append(block.get("text", ""))
-                except json.JSONDecodeError:
-                    continue
+        # Parse the JSON result message
+        try:
+            data = json_loads(stdout)
+        except JSONDecodeError:
+            logger.error(f"Unexpected Claude CLI output: {repr(stdout[:200])}")
+            return "Error: Could not parse Claude CLI output"
+        
+        result = data.get("result", "")
+        if data.get("is_error"):
+            return f"Error: {format_usage_limit_message(result)}"
         
-        return ''.join(response_parts).strip()
+        return result.strip()
         
     except Exception as e:
         logger.error(f"Error calling Claude CLI: {e}")
@@ -979,9 +1049,8 @@ async def claude_query(ctx, *, prompt: str = ""):
         
         response = await call_claude_enhanced(
             prompt=full_prompt,
-            system_prompt="You are a helpful Discord bot assistant. Keep responses concise and Discord-friendly.",
-            tools=["Read", "Write", "Edit", "MultiEdit", "LS", "NotebookRead", "NotebookEdit", 
-                   "Glob", "Grep", "Task", "Bash", "WebFetch", "WebSearch", "TodoRead", "TodoWrite", "exit_plan_mode"],
+            system_prompt=CLAUDE_SYSTEM_PROMPT,
+            tools=CLAUDE_TOOLS,
             continue_conversation=True,
             ctx=ctx
         )
@@ -1034,9 +1103,8 @@ async def claude_new_query(ctx, *, prompt: str = ""):
         
         response = await call_claude_enhanced(
             prompt=full_prompt,
-            system_prompt="You are a helpful Discord bot assistant. Keep responses concise and Discord-friendly.",
-            tools=["Read", "Write", "Edit", "MultiEdit", "LS", "NotebookRead", "NotebookEdit", 
-                   "Glob", "Grep", "Task", "Bash", "WebFetch", "WebSearch", "TodoRead", "TodoWrite", "exit_plan_mode"],
+            system_prompt=CLAUDE_SYSTEM_PROMPT,
+            tools=CLAUDE_TOOLS,
             ctx=ctx
         )
         
@@ -1087,9 +1155,8 @@ async def claude_resume_query(ctx, session_id: str, *, prompt: str = ""):
         
         response = await call_claude_enhanced(
             prompt=full_prompt,
-            system_prompt="You are a helpful Discord bot assistant. Keep responses concise and Discord-friendly.",
-            tools=["Read", "Write", "Edit", "MultiEdit", "LS", "NotebookRead", "NotebookEdit", 
-                   "Glob", "Grep", "Task", "Bash", "WebFetch", "WebSearch", "TodoRead", "TodoWrite", "exit_plan_mode"],
+            system_prompt=CLAUDE_SYSTEM_PROMPT,
+            tools=CLAUDE_TOOLS,
             resume_session=session_id,
             ctx=ctx
         )
@@ -1127,7 +1194,7 @@ async def stop_claude(ctx):
         await ctx.send("🛑 Stopping Claude process gracefully...")
         
         # Try graceful termination first
-        current_claude_process.terminate()
+        _signal_claude_process(current_claude_process)
         logger.info("Sent SIGTERM to Claude process")
         
         try:
@@ -1138,7 +1205,7 @@ async def stop_claude(ctx):
         except asyncio.TimeoutError:
             # Force kill if it doesn't terminate gracefully
             logger.warning("Claude process did not terminate gracefully, forcing kill")
-            current_claude_process.kill()
+            _signal_claude_process(current_claude_process, kill=True)
             await current_claude_process.wait()
             termination_method = "force killed"
         
@@ -1224,4 +1291,10 @@ async def main():
         await bot.close()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    configure_logging()
+    if uvloop is not None:
+        # libuv-based loop with lower overhead for subprocess pipes, timers and sockets
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(main())
+    else:
+        asyncio.run(main())